@@ -6,24 +6,228 @@ to support submission and reading of onyx analyses.
 """
 
 # Imports - ordered (can use ruff to do this automatically)
+import atexit
+import copy
 import datetime
 import importlib.metadata as metadata
 import json
 import logging
+import math
 import os
+import random
+import threading
 import time
-from functools import wraps
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import cache, wraps
 from pathlib import Path
 
 from onyx import OnyxClient, OnyxConfig, OnyxEnv
 from onyx.exceptions import OnyxClientError, OnyxConfigError, OnyxConnectionError, OnyxHTTPError
 
+try:  # Optional faster json serialization, install with onyx-analysis-helper[fast]
+    import orjson
+except ImportError:
+    orjson = None
+
 # Set up e.g. config settings
-# Set up onyx config
-CONFIG = OnyxConfig(
-    domain=os.environ[OnyxEnv.DOMAIN],
-    token=os.environ[OnyxEnv.TOKEN],
+_LOG = logging.getLogger(__name__)
+_DEBUG_DEDUP_WINDOW = 5
+
+# Retry settings for connection errors, can be overridden with env vars
+_MAX_ATTEMPTS_ENV = "ONYX_ANALYSIS_MAX_ATTEMPTS"
+_RETRY_BASE_DELAY_ENV = "ONYX_ANALYSIS_RETRY_BASE_DELAY"
+_DEFAULT_MAX_ATTEMPTS = 3
+_DEFAULT_RETRY_BASE_DELAY = 5.0
+_RETRY_MAX_DELAY = 30
+
+# Onyx analysis fields
+_REQUIRED_FIELDS = frozenset(
+    {
+        "analysis_date",
+        "name",
+        "pipeline_name",
+        "pipeline_version",
+        "result",
+        "identifiers",
+    }
+)
+_OUTPUT_FIELDS = ("report", "outputs")
+_JSON_FIELDS = ("methods", "result_metrics")
+_VALID_ATTRIBUTES = frozenset(
+    {
+        "published_date",
+        "site",
+        "analysis_id",
+        "analysis_date",
+        "name",
+        "description",
+        "pipeline_name",
+        "pipeline_url",
+        "pipeline_version",
+        "pipeline_command",
+        "methods",
+        "result",
+        "result_metrics",
+        "report",
+        "outputs",
+        "upstream_analyses",
+        "downstream_analyses",
+        "identifiers",
+        "synthscape_records",
+        "mscape_records",
+    }
+)
+
+# Error messages for failed calls to Onyx
+_EXCEPTIONS_URL = "https://climb-tre.github.io/onyx-client/api/documentation/exceptions/"
+_CONNECTION_ERROR_MSG = (
+    "OnyxConnectionError: %s. Connection to Onyx failed %s times, exiting program"
+)
+_CONFIG_ERROR_MSG = (
+    "OnyxConfigError: %s. Check credentials and details in OnyxConfig are correct. "
+    f"See {_EXCEPTIONS_URL} for more details."
 )
+_CLIENT_ERROR_MSG = (
+    "OnyxClientError: %s. Check calls to OnyxClient are correct and required arguments "
+    f"e.g. climb_id are present. See {_EXCEPTIONS_URL} for more details"
+)
+_HTTP_ERROR_MSG = f"OnyxHTTPError: %s. See {_EXCEPTIONS_URL} for more details"
+_UNHANDLED_ERROR_MSG = f"Unhandled error: %s. See {_EXCEPTIONS_URL} for more details"
+
+
+class _RepeatedDebugFilter(logging.Filter):
+    """Drops DEBUG records repeating a message already logged within the
+    last window seconds, e.g. connection attempts during batch submissions.
+    Records at INFO and above always pass.
+    """
+
+    _MAX_TRACKED = 1024
+
+    def __init__(self, window: float):
+        super().__init__()
+        self.window = window
+        self._last_logged: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+
+        message = record.getMessage()
+        with self._lock:
+            last_logged = self._last_logged.get(message)
+            if last_logged is not None and record.created - last_logged < self.window:
+                return False
+            if len(self._last_logged) >= self._MAX_TRACKED:
+                self._last_logged = {
+                    logged_message: logged_time
+                    for logged_message, logged_time in self._last_logged.items()
+                    if record.created - logged_time < self.window
+                }
+            self._last_logged[message] = record.created
+
+        return True
+
+
+_LOG.addFilter(_RepeatedDebugFilter(_DEBUG_DEDUP_WINDOW))
+
+
+def _env_setting(name: str, default, convert, minimum):
+    "Returns a numeric setting from an env var, or the default if unset or invalid"
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        setting = convert(value)
+    except ValueError:
+        setting = None
+    if setting is None or not setting >= minimum:
+        _LOG.warning("Invalid value for %s: %r. Using default of %s", name, value, default)
+        return default
+
+    return setting
+
+
+@cache
+def _retry_settings() -> tuple[int, float]:
+    """Returns maximum connection attempts and base retry delay. Read from
+    env vars on first use so a bad value can't break importing the module.
+    """
+    max_attempts = _env_setting(_MAX_ATTEMPTS_ENV, _DEFAULT_MAX_ATTEMPTS, int, minimum=1)
+    base_delay = _env_setting(_RETRY_BASE_DELAY_ENV, _DEFAULT_RETRY_BASE_DELAY, float, minimum=0)
+
+    return max_attempts, base_delay
+
+
+def _retry_delay(connection_attempts: int) -> float:
+    """Returns seconds to wait before retrying a connection. Exponential
+    backoff with full jitter so parallel workers don't retry in step.
+    """
+    _, base_delay = _retry_settings()
+    max_delay = min(_RETRY_MAX_DELAY, base_delay * 2 ** (connection_attempts - 1))
+
+    return random.uniform(0, max_delay)
+
+
+# Error handlers for failed calls to Onyx
+class _ResponseBody:
+    """Defers parsing an Onyx error response until the log message is
+    formatted. Falls back to the raw text if the body is not valid json.
+    """
+
+    __slots__ = ("response",)
+
+    def __init__(self, response):
+        self.response = response
+
+    def __str__(self) -> str:
+        try:
+            return str(self.response.json())
+        except Exception:
+            return str(getattr(self.response, "text", self.response))
+
+
+def _on_connection_error(exc: OnyxConnectionError) -> None:
+    max_attempts, _ = _retry_settings()
+    _LOG.error(_CONNECTION_ERROR_MSG, exc, max_attempts)
+
+
+def _on_config_error(exc: OnyxConfigError) -> None:
+    _LOG.error(_CONFIG_ERROR_MSG, exc)
+
+
+def _on_client_error(exc: OnyxClientError) -> None:
+    _LOG.error(_CLIENT_ERROR_MSG, exc)
+
+
+def _on_http_error(exc: OnyxHTTPError) -> None:
+    _LOG.error(_HTTP_ERROR_MSG, _ResponseBody(exc.response))
+
+
+def _on_unhandled_error(exc: Exception) -> None:
+    _LOG.error(_UNHANDLED_ERROR_MSG, exc)
+
+
+_ERROR_HANDLERS = {
+    OnyxConnectionError: _on_connection_error,
+    OnyxConfigError: _on_config_error,
+    OnyxClientError: _on_client_error,
+    OnyxHTTPError: _on_http_error,
+    Exception: _on_unhandled_error,
+}
+
+
+def _handle_onyx_error(exc: Exception) -> tuple[None, int]:
+    """Logs a failed call to Onyx using the handler registered for the
+    closest matching exception class e.g. OnyxRequestError is handled as
+    an OnyxHTTPError.
+    """
+    handler = next(_ERROR_HANDLERS[cls] for cls in type(exc).__mro__ if cls in _ERROR_HANDLERS)
+    handler(exc)
+
+    return None, 1
 
 
 # Onyx query decorator
@@ -34,87 +238,100 @@ def call_to_onyx(func):
 
     @wraps(func)
     def call_to_onyx_wrapper(*args, **kwargs):
-        connection_attempts = 1
-        success = False
-
-        while success is False:
-            try:
-                logging.debug(
-                    "Attempting connection to Onyx. Attempt number %s", connection_attempts
-                )
-                result, exitcode = func(*args, **kwargs)
-                success = True
-                logging.debug("Successful connection to onyx")
-
-                return result, exitcode
-
-            except OnyxConnectionError as exc:
-                if connection_attempts < 3:
-                    connection_attempts += 1
-                    logging.debug("OnyxConnectionError: %s. Retrying connection in 5 seconds", exc)
-                    time.sleep(5)
-
-                else:
-                    logging.error(
-                        """OnyxConnectionError: %s. Connection to Onyx failed %s times,
-                              exiting program""",
-                        exc,
-                        connection_attempts,
+        max_attempts, _ = _retry_settings()
+        try:
+            for connection_attempts in range(1, max_attempts + 1):
+                if _LOG.isEnabledFor(logging.DEBUG):
+                    _LOG.debug(
+                        "Attempting connection to Onyx. Attempt number %s", connection_attempts
                     )
-                    result = None
-                    exitcode = 1
+                try:
+                    result, exitcode = func(*args, **kwargs)
+                except OnyxConnectionError as exc:
+                    if connection_attempts == max_attempts:
+                        raise
+                    delay = _retry_delay(connection_attempts)
+                    _LOG.debug(
+                        "OnyxConnectionError: %s. Retrying connection in %.1f seconds", exc, delay
+                    )
+                    time.sleep(delay)
+                else:
+                    if _LOG.isEnabledFor(logging.DEBUG):
+                        _LOG.debug("Successful connection to onyx")
                     return result, exitcode
 
-            except OnyxConfigError as exc:
-                logging.error(
-                    """OnyxConfigError: %s. Check credentials and details in OnyxConfig
-                          are correct. See
-                          https://climb-tre.github.io/onyx-client/api/documentation/exceptions/
-                          for more details.""",
-                    exc,
-                )
-                result = None
-                exitcode = 1
-                return result, exitcode
-
-            except OnyxClientError as exc:
-                logging.error(
-                    """OnyxClientError: %s. Check calls to OnyxClient are correct
-                          and required arguments e.g. climb_id are present. See
-                          https://climb-tre.github.io/onyx-client/api/documentation/exceptions/
-                          for more details""",
-                    exc,
-                )
-                result = None
-                exitcode = 1
-                return result, exitcode
-
-            except OnyxHTTPError as exc:
-                logging.error(
-                    """OnyxHTTPError: %s. See
-                          https://climb-tre.github.io/onyx-client/api/documentation/exceptions/
-                          for more details""",
-                    exc.response.json(),
-                )
-                result = None
-                exitcode = 1
-                return result, exitcode
-
-            except Exception as exc:
-                logging.error(
-                    """Unhandled error: %s. See
-                          https://climb-tre.github.io/onyx-client/api/documentation/exceptions/
-                          for more details""",
-                    exc,
-                )
-                result = None
-                exitcode = 1
-                return result, exitcode
+        except Exception as exc:
+            return _handle_onyx_error(exc)
 
     return call_to_onyx_wrapper
 
 
 # Functions
+def _orjson_compatible(value) -> bool:
+    """Checks orjson would write value exactly as json.dump does i.e. only
+    plain json types, str dict keys, finite floats and ints within 64 bits.
+    """
+    value_type = type(value)
+    if value is None or value_type in (str, bool):
+        return True
+    if value_type is int:
+        return -(2**63) <= value < 2**64
+    if value_type is float:
+        return math.isfinite(value)
+    if value_type in (list, tuple):
+        return all(_orjson_compatible(item) for item in value)
+    if value_type is dict:
+        return all(type(key) is str and _orjson_compatible(item) for key, item in value.items())
+
+    return False
+
+
+@cache
+def _config() -> OnyxConfig:
+    """Returns onyx config from environment variables. Built on first use
+    so importing the module does not require onyx credentials to be set.
+    """
+    return OnyxConfig(
+        domain=os.environ[OnyxEnv.DOMAIN],
+        token=os.environ[OnyxEnv.TOKEN],
+    )
+
+
+# Pool of idle clients with open sessions, closed on interpreter exit
+_IDLE_CLIENTS: list[OnyxClient] = []
+_CLIENT_SESSIONS = ExitStack()
+_CLIENT_LOCK = threading.Lock()
+atexit.register(_CLIENT_SESSIONS.close)
+
+
+@contextmanager
+def _onyx_client() -> Iterator[OnyxClient]:
+    """Lends an OnyxClient from a shared pool so connections are reused
+    across calls to Onyx. A new client is only opened if all pooled clients
+    are in use, so the pool grows to the peak number of concurrent calls.
+    """
+    with _CLIENT_LOCK:
+        if _IDLE_CLIENTS:
+            client = _IDLE_CLIENTS.pop()
+        else:
+            client = _CLIENT_SESSIONS.enter_context(OnyxClient(_config()))
+    try:
+        yield client
+    finally:
+        with _CLIENT_LOCK:
+            _IDLE_CLIENTS.append(client)
+
+
+@cache
+def _package_metadata(package_name: str) -> tuple[str, str, str]:
+    """Returns name, version and url for an installed package. Cached as
+    the metadata lookup reads and parses the package METADATA file.
+    """
+    package_metadata = dict(metadata.metadata(package_name))
+    # Get url from toml - add to template
+    pipeline_url = package_metadata["Project-URL"].split(", ")[1]
+
+    return package_metadata["Name"], package_metadata["Version"], pipeline_url
 
 
 class OnyxAnalysis:
@@ -145,22 +362,19 @@ class OnyxAnalysis:
 
     def add_package_metadata(self, package_name: str) -> None:
         "Adds package metadata to onyx analysis object"
-        package_metadata = dict(metadata.metadata(package_name))
-        self.pipeline_name = package_metadata["Name"]
-        self.pipeline_version = package_metadata["Version"]
-        self.pipeline_url = package_metadata["Project-URL"].split(", ")[
-            1
-        ]  # Get url from toml - add to template
+        self.pipeline_name, self.pipeline_version, self.pipeline_url = _package_metadata(
+            package_name
+        )
 
     def add_methods(self, methods_dict: dict) -> bool:
         """Attempts to add methods to onyx analysis object. If results are
         invalid, returns results_fail.
         """
         if isinstance(methods_dict, dict):
-            self.methods = json.dumps(methods_dict)
+            self.methods = methods_dict
             methods_fail = False
         else:
-            logging.error("Error: Methods must be in dict format")
+            _LOG.error("Error: Methods must be in dict format")
             methods_fail = True
 
         return methods_fail
@@ -171,10 +385,10 @@ class OnyxAnalysis:
         """
         if isinstance(results_dict, dict):
             self.result = top_result
-            self.result_metrics = json.dumps(results_dict)
+            self.result_metrics = results_dict
             results_fail = False
         else:
-            logging.error("Error: result_metrics must be in dict format")
+            _LOG.error("Error: result_metrics must be in dict format")
             results_fail = True
 
         return results_fail
@@ -201,17 +415,23 @@ class OnyxAnalysis:
 
         return outputs_fail
 
+    def to_dict(self) -> dict:
+        """Returns a deep copy of the onyx analysis fields set on the object,
+        so nested values e.g. methods can't be changed through the copy.
+        """
+        return copy.deepcopy(vars(self))
+
     # Private methods for creating new analysis object
     def _set_analysis_date(self) -> None:
         "Checks if analysis date is present and sets today's date if it isn't"
         if not hasattr(self, "analysis_date"):
-            self.analysis_date = datetime.datetime.now().date().isoformat()
+            self.analysis_date = time.strftime("%Y-%m-%d")
 
     # Add in function to set s3 output path, other optional fields
     # Create analysis in Onyx
-    @call_to_onyx
     def write_analysis_to_onyx(self, server: str, dryrun: bool) -> tuple[str, int]:
-        """Attempts to add onyx analysis to object.
+        """Attempts to add onyx analysis to object. A dry run checks the
+        analysis object locally and does not contact Onyx.
         Arguments:
             server -- Server submitting data to
             dryrun -- Specify if test or real upload to onyx
@@ -220,17 +440,59 @@ class OnyxAnalysis:
                       None if upload fails
             exitcode -- 0 if successful, 1 if fail
         """
+        if dryrun:
+            if any(self.check_analysis_object()):
+                return None, 1
+            return {}, 0
+
+        return self._create_analysis_in_onyx(server)
 
-        with OnyxClient(CONFIG) as client:
-            result = client.create_analysis(project=server, fields=vars(self), test=dryrun)
+    @call_to_onyx
+    def _create_analysis_in_onyx(self, server: str) -> tuple[str, int]:
+        "Creates analysis in Onyx"
+        with _onyx_client() as client:
+            result = client.create_analysis(project=server, fields=self.to_dict())
         exitcode = 0
 
         return result, exitcode
 
+    @staticmethod
+    def write_batch(
+        analyses: list["OnyxAnalysis"], server: str, dryrun: bool, max_workers: int = 8
+    ) -> list[tuple[str, int]]:
+        """Writes multiple onyx analyses concurrently, so requests to Onyx
+        overlap rather than running one after another. Workers borrow
+        clients from the shared pool, so sessions are reused across batches.
+        Arguments:
+            analyses -- OnyxAnalysis objects to submit
+            server -- Server submitting data to
+            dryrun -- Specify if test or real upload to onyx
+            max_workers -- Maximum number of concurrent submissions
+        Returns:
+            List of (result, exitcode) tuples from write_analysis_to_onyx,
+            in the same order as analyses
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(
+                executor.map(
+                    lambda analysis: analysis.write_analysis_to_onyx(server, dryrun), analyses
+                )
+            )
+
     # Write analysis object to json
     def write_analysis_to_json(self, result_file: os.path) -> None:
-        "Writes onyx analysis object to json"
-        fields_dict = vars(self)
+        """Writes onyx analysis object to json. Uses orjson if installed and
+        the fields are plain json values, otherwise json.dump e.g. for NaN,
+        non-str keys or float subclasses, so the output is the same either way.
+        """
+        fields_dict = self.to_dict()
+
+        if orjson is not None and _orjson_compatible(fields_dict):
+            try:
+                Path(result_file).write_bytes(orjson.dumps(fields_dict))
+                return result_file
+            except TypeError:  # Includes orjson.JSONEncodeError e.g. deeply nested values
+                pass
 
         with Path(result_file).open("w") as file:
             json.dump(fields_dict, file)
@@ -253,23 +515,14 @@ class OnyxAnalysis:
         required_field_fail = False
         # Check required fields
         missing_field = False
-        required_fields = [
-            "analysis_date",
-            "name",
-            "pipeline_name",
-            "pipeline_version",
-            "result",
-            "identifiers",
-        ]
-        if not all(field in fields_dict for field in required_fields):
-            missing_fields = [field for field in required_fields if field not in fields_dict]
-            logging.error("Missing required fields: %s", missing_fields)
+        missing_fields = _REQUIRED_FIELDS - fields_dict.keys()
+        if missing_fields:
+            _LOG.error("Missing required fields: %s", sorted(missing_fields))
             missing_field = True
 
         # Check outputs
-        output_fields = ["report", "outputs"]
-        if not any(field in output_fields for field in fields_dict):
-            logging.error("Fields dict must contain one of: %s", output_fields)
+        if fields_dict.keys().isdisjoint(_OUTPUT_FIELDS):
+            _LOG.error("Fields dict must contain one of: %s", list(_OUTPUT_FIELDS))
             missing_field = True
         if missing_field:
             required_field_fail = True
@@ -282,33 +535,10 @@ class OnyxAnalysis:
         analysis_dict = vars(self)
         attribute_fail = False
 
-        valid_attributes = [
-            "published_date",
-            "site",
-            "analysis_id",
-            "analysis_date",
-            "name",
-            "description",
-            "pipeline_name",
-            "pipeline_url",
-            "pipeline_version",
-            "pipeline_command",
-            "methods",
-            "result",
-            "result_metrics",
-            "report",
-            "outputs",
-            "upstream_analyses",
-            "downstream_analyses",
-            "identifiers",
-            "synthscape_records",
-            "mscape_records",
-        ]
-
-        invalid_attributes = list(analysis_dict.keys() - set(valid_attributes))
-
-        if invalid_attributes != []:
-            logging.error("Invalid attribute in onyx analysis: %s", invalid_attributes)
+        invalid_attributes = analysis_dict.keys() - _VALID_ATTRIBUTES
+
+        if invalid_attributes:
+            _LOG.error("Invalid attribute in onyx analysis: %s", sorted(invalid_attributes))
             attribute_fail = True
 
         return attribute_fail
@@ -341,13 +571,21 @@ class OnyxAnalysis:
     @call_to_onyx
     def _get_analysis_from_onyx(analysis_id: str, server: str) -> tuple[dict, int]:
         "Retrieves analysis from Onyx"
-        with OnyxClient(CONFIG) as client:
+        with _onyx_client() as client:
             analysis_dict = client.get_analysis(server, analysis_id)
         exitcode = 0
 
         return analysis_dict, exitcode
 
     def _set_analysis_attributes(self, analysis_dict: dict) -> None:
-        "Sets class attributes from input dictionary"
+        """Sets class attributes from input dictionary. Methods and result
+        metrics stored as json strings are decoded to dicts, strings that
+        are not valid json are kept as they are.
+        """
         for key, value in analysis_dict.items():
+            if key in _JSON_FIELDS and isinstance(value, str):
+                try:
+                    value = json.loads(value)
+                except json.JSONDecodeError as exc:
+                    _LOG.error("Could not decode %s as json, keeping it as a string: %s", key, exc)
             setattr(self, key, value)
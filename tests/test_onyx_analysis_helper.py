@@ -7,42 +7,104 @@ pytest tests/test_onyx_analysis_helper.py -rP --basetemp tests/test_outputs/
 WARNING: Using --basetemp on an existing folder will overwrite all files.
 """
 
+import copy
 import datetime
+import json
+import logging
+import re
+import time
 from pathlib import Path
+from types import MappingProxyType
 
 import pytest
-import regex as re
+from onyx import OnyxClient
+from onyx.exceptions import (
+    OnyxClientError,
+    OnyxConfigError,
+    OnyxConnectionError,
+    OnyxRequestError,
+)
 
-from onyx_analysis_helper.onyx_analysis_helper_functions import OnyxAnalysis
+from onyx_analysis_helper.onyx_analysis_helper_functions import (
+    _IDLE_CLIENTS,
+    OnyxAnalysis,
+    _handle_onyx_error,
+    _onyx_client,
+    _RepeatedDebugFilter,
+    _retry_delay,
+    _retry_settings,
+    call_to_onyx,
+)
 
+_VERSION_RE = re.compile(r"\d+\.\d+\.\d+")
 
-# Fixtures
-@pytest.fixture
-def example_methods():
-    methods_dict = {"method1": "method example 1", "method2": "method example 2"}
 
-    return methods_dict
+class ExampleResponse:
+    def json(self):
+        return {"detail": "Example error"}
 
 
-@pytest.fixture
-def expected_methods_json():
-    methods_json = '{"method1": "method example 1", "method2": "method example 2"}'
+class ExampleInvalidResponse:
+    text = "<html>Bad Gateway</html>"
+
+    def json(self):
+        raise ValueError("Invalid json")
+
+
+# Test data shared by the fixtures below. Fixtures return read-only views,
+# use copy_fields to give each analysis its own copy of nested values.
+_EXAMPLE_METHODS = {"method1": "method example 1", "method2": "method example 2"}
+
+_EXAMPLE_RESULTS = {"Example result 1": 9, "Example reuslt 2": "Fail", "Example result 3": 0.3}
+
+_COMPLETE_FIELDS = {
+    "name": "test-analysis",
+    "description": "This is a test analysis",
+    "analysis_date": "2025-08-21",
+    "pipeline_name": "test-pipeline",
+    "pipeline_url": "test-pipeline-url",
+    "pipeline_version": "0.1.0",
+    "result": "test result",
+    "upstream_analyses": [],
+    "report": "",
+    "outputs": "path/to/outputs",
+    "methods": _EXAMPLE_METHODS,
+    "result_metrics": _EXAMPLE_RESULTS,
+    "synthscape_records": ["C-123456789"],
+    "identifiers": [],
+}
+
+
+def without_fields(*fields):
+    return {key: value for key, value in _COMPLETE_FIELDS.items() if key not in fields}
+
+
+_MISSING_FIELDS = without_fields("name")
+
+_MISSING_OUTPUT_FIELDS = without_fields("report", "outputs")
+
+_MISSING_BOTH_FIELDS = without_fields("name", "report", "outputs")
 
-    return methods_json
+_INVALID_FIELDS = {"invalid_name": "test-analysis", **without_fields("name")}
 
 
+def copy_fields(field_dict):
+    return copy.deepcopy(dict(field_dict))
+
+
+# Fixtures
 @pytest.fixture
-def example_results():
-    methods_dict = {"Example result 1": 9, "Example reuslt 2": "Fail", "Example result 3": 0.3}
+def example_methods():
+    methods_dict = dict(_EXAMPLE_METHODS)
 
     return methods_dict
 
 
 @pytest.fixture
-def expected_results():
-    methods_json = '{"Example result 1": 9, "Example reuslt 2": "Fail", "Example result 3": 0.3}'
+def example_results():
+    results_dict = dict(_EXAMPLE_RESULTS)
 
-    return methods_json
+    return results_dict
 
 
 @pytest.fixture
@@ -51,143 +113,72 @@ def onyx_json_file_path(tmp_path_factory):
     return str(tmp_dir)
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def complete_field_dict():
-    field_dict = {
-        "name": "test-analysis",
-        "description": "This is a test analysis",
-        "analysis_date": "2025-08-21",
-        "pipeline_name": "test-pipeline",
-        "pipeline_url": "test-pipeline-url",
-        "pipeline_version": "0.1.0",
-        "result": "test result",
-        "upstream_analyses": [],
-        "report": "",
-        "outputs": "path/to/outputs",
-        "methods": '{"method1": "method example 1", "method2": "method example 2"}',
-        "result_metrics": '{"Example result 1": 9, "Example reuslt 2": "Fail", "Example result 3": 0.3}',
-        "synthscape_records": ["C-123456789"],
-        "identifiers": [],
-    }
-
-    return field_dict
+    return MappingProxyType(_COMPLETE_FIELDS)
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def missing_field_dict():
-    field_dict = {
-        "description": "This is a test analysis",
-        "analysis_date": "2025-08-21",
-        "pipeline_name": "test-pipeline",
-        "pipeline_url": "test-pipeline-url",
-        "pipeline_version": "0.1.0",
-        "result": "test result",
-        "upstream_analyses": [],
-        "report": "",
-        "outputs": "path/to/outputs",
-        "methods": '{"method1": "method example 1", "method2": "method example 2"}',
-        "result_metrics": '{"Example result 1": 9, "Example reuslt 2": "Fail", "Example result 3": 0.3}',
-        "synthscape_records": ["C-123456789"],
-        "identifiers": [],
-    }
-
-    return field_dict
+    return MappingProxyType(_MISSING_FIELDS)
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def missing_field_log():
-    logs = ["Missing required fields: ['name']"]
+    logs = ("Missing required fields: ['name']",)
     return logs
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def missing_output_dict():
-    field_dict = {
-        "name": "test-analysis",
-        "description": "This is a test analysis",
-        "analysis_date": "2025-08-21",
-        "pipeline_name": "test-pipeline",
-        "pipeline_url": "test-pipeline-url",
-        "pipeline_version": "0.1.0",
-        "result": "test result",
-        "upstream_analyses": [],
-        "methods": '{"method1": "method example 1", "method2": "method example 2"}',
-        "result_metrics": '{"Example result 1": 9, "Example result 2": "Fail", "Example result 3": 0.3}',
-        "synthscape_records": ["C-123456789"],
-        "identifiers": [],
-    }
-
-    return field_dict
+    return MappingProxyType(_MISSING_OUTPUT_FIELDS)
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def missing_output_log():
-    logs = ["Fields dict must contain one of: ['report', 'outputs']"]
+    logs = ("Fields dict must contain one of: ['report', 'outputs']",)
     return logs
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def missing_both_dict():
-    field_dict = {
-        "description": "This is a test analysis",
-        "analysis_date": "2025-08-21",
-        "pipeline_name": "test-pipeline",
-        "pipeline_url": "test-pipeline-url",
-        "pipeline_version": "0.1.0",
-        "result": "test result",
-        "upstream_analyses": [],
-        "methods": '{"method1": "method example 1", "method2": "method example 2"}',
-        "result_metrics": '{"Example result 1": 9, "Example reuslt 2": "Fail", "Example result 3": 0.3}',
-        "synthscape_records": ["C-123456789"],
-        "identifiers": [],
-    }
-
-    return field_dict
+    return MappingProxyType(_MISSING_BOTH_FIELDS)
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def missing_both_log():
-    logs = [
+    logs = (
         "Missing required fields: ['name']",
         "Fields dict must contain one of: ['report', 'outputs']",
-    ]
+    )
     return logs
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def example_onyx_json_file():
     file = "tests/test_data/example_onyx_analysis.json"
 
     return file
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
+def example_onyx_parsed(example_onyx_json_file):
+    with Path(example_onyx_json_file).open("r") as file:
+        data = json.load(file)
+
+    return MappingProxyType(data)
+
+
+@pytest.fixture(scope="session")
 def example_onyx_json_file_fail():
     file = "tests/test_data/example_onyx_analysis_fail.json"
 
     return file
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def invalid_field_dict():
-    field_dict = {
-        "invalid_name": "test-analysis",
-        "description": "This is a test analysis",
-        "analysis_date": "2025-08-21",
-        "pipeline_name": "test-pipeline",
-        "pipeline_url": "test-pipeline-url",
-        "pipeline_version": "0.1.0",
-        "result": "test result",
-        "upstream_analyses": [],
-        "report": "",
-        "outputs": "path/to/outputs",
-        "methods": '{"method1": "method example 1", "method2": "method example 2"}',
-        "result_metrics": '{"Example result 1": 9, "Example reuslt 2": "Fail", "Example result 3": 0.3}',
-        "synthscape_records": ["C-123456789"],
-        "identifiers": [],
-    }
-
-    return field_dict
+    return MappingProxyType(_INVALID_FIELDS)
 
 
 @pytest.fixture
@@ -204,15 +195,65 @@ def example_result_file():
     return result_dir
 
 
+@pytest.fixture
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(
+        "onyx_analysis_helper.onyx_analysis_helper_functions.time.sleep", lambda delay: None
+    )
+
+
+@pytest.fixture
+def retry_env(monkeypatch):
+    _retry_settings.cache_clear()
+    yield monkeypatch
+    _retry_settings.cache_clear()
+
+
+def make_onyx_call(*outcomes):
+    """Returns a call_to_onyx decorated function that raises or returns each
+    outcome in turn, and the list of calls made to it.
+    """
+    calls = []
+
+    @call_to_onyx
+    def onyx_call():
+        outcome = outcomes[min(len(calls), len(outcomes) - 1)]
+        calls.append(outcome)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome, 0
+
+    return onyx_call, calls
+
+
 # Tests
-def test_add_analysis_details():
-    expected_name = "example_analysis"
-    expected_description = "This is an example analysis."
+@pytest.mark.parametrize(
+    "setter,args,expected_attributes",
+    [
+        (
+            "add_analysis_details",
+            ("example_analysis", "This is an example analysis."),
+            {"name": "example_analysis", "description": "This is an example analysis."},
+        ),
+        ("add_methods", (dict(_EXAMPLE_METHODS),), {"methods": _EXAMPLE_METHODS}),
+        (
+            "add_results",
+            ("headline result", dict(_EXAMPLE_RESULTS)),
+            {"result": "headline result", "result_metrics": _EXAMPLE_RESULTS},
+        ),
+        (
+            "add_server_records",
+            ("C-123456789", "synthscape"),
+            {"synthscape_records": ["C-123456789"]},
+        ),
+    ],
+)
+def test_add_fields(setter, args, expected_attributes):
     analysis = OnyxAnalysis()
-    analysis.add_analysis_details(expected_name, expected_description)
+    getattr(analysis, setter)(*args)
 
-    assert analysis.name == expected_name
-    assert analysis.description == expected_description
+    for attribute, expected in expected_attributes.items():
+        assert getattr(analysis, attribute) == expected
 
 
 def test_add_analysis_date_no_date():
@@ -235,54 +276,143 @@ def test_add_analysis_date_already_date():
 def test_add_package_metadata():
     analysis = OnyxAnalysis()
     analysis.add_package_metadata("climb-onyx-client")
-    version_check = re.fullmatch("[0-9]+\\.[0-9]+\\.[0-9]+", analysis.pipeline_version)
+    version_check = _VERSION_RE.fullmatch(analysis.pipeline_version)
 
     assert analysis.pipeline_name == "climb-onyx-client"
     assert version_check is not None
     assert analysis.pipeline_url == "https://github.com/CLIMB-TRE/onyx-client"
 
 
-def test_add_methods(example_methods, expected_methods_json):
+def test_write_analysis_to_json(onyx_json_file_path, complete_field_dict):
+    analysis = OnyxAnalysis()
+    analysis.__dict__.update(copy_fields(complete_field_dict))
+    analysis.write_analysis_to_json(onyx_json_file_path)
+
+    assert Path(onyx_json_file_path).exists()
+
+
+def test_write_analysis_to_json_methods(onyx_json_file_path, example_methods, example_results):
     analysis = OnyxAnalysis()
     analysis.add_methods(example_methods)
+    analysis.add_results("headline result", example_results)
+    analysis.write_analysis_to_json(onyx_json_file_path)
 
-    assert analysis.methods == expected_methods_json
+    with Path(onyx_json_file_path).open("r") as file:
+        written = json.load(file)
 
+    assert written["methods"] == example_methods
+    assert written["result_metrics"] == example_results
 
-def test_add_results(example_results, expected_results):
-    result = "headline result"
+
+def test_write_analysis_to_onyx_dryrun_pass(complete_field_dict):
     analysis = OnyxAnalysis()
-    analysis.add_results(result, example_results)
+    analysis._set_analysis_attributes(copy_fields(complete_field_dict))
 
-    assert analysis.result == result
-    assert analysis.result_metrics == expected_results
+    assert analysis.write_analysis_to_onyx("synthscape", dryrun=True) == ({}, 0)
 
 
-def test_add_server_records():
-    sample_id = "C-123456789"
-    server = "synthscape"
+def test_write_analysis_to_onyx_dryrun_fail(invalid_field_dict):
     analysis = OnyxAnalysis()
-    analysis.add_server_records(sample_id, server)
+    analysis._set_analysis_attributes(copy_fields(invalid_field_dict))
 
-    assert analysis.synthscape_records == ["C-123456789"]
+    assert analysis.write_analysis_to_onyx("synthscape", dryrun=True) == (None, 1)
 
 
-def test_write_analysis_to_json(onyx_json_file_path, complete_field_dict):
+def test_write_batch_dryrun(complete_field_dict, invalid_field_dict):
+    analyses = []
+    for field_dict in [complete_field_dict, invalid_field_dict, complete_field_dict]:
+        analysis = OnyxAnalysis()
+        analysis._set_analysis_attributes(copy_fields(field_dict))
+        analyses.append(analysis)
+
+    results = OnyxAnalysis.write_batch(analyses, "synthscape", dryrun=True)
+
+    assert results == [({}, 0), (None, 1), ({}, 0)]
+
+
+def test_write_batch_reuses_clients(complete_field_dict, monkeypatch):
+    used_clients = set()
+
+    def create_analysis(client, project, fields):
+        used_clients.add(id(client))
+        time.sleep(0.01)
+        return "example-id"
+
+    monkeypatch.setattr(OnyxClient, "create_analysis", create_analysis)
+    analyses = []
+    for _ in range(16):
+        analysis = OnyxAnalysis()
+        analysis._set_analysis_attributes(copy_fields(complete_field_dict))
+        analyses.append(analysis)
+
+    initial_pool_size = len(_IDLE_CLIENTS)
+    OnyxAnalysis.write_batch(analyses, "synthscape", dryrun=False, max_workers=4)
+    pool_size = len(_IDLE_CLIENTS)
+    for _ in range(2):
+        results = OnyxAnalysis.write_batch(analyses, "synthscape", dryrun=False, max_workers=4)
+
+    assert results == [("example-id", 0)] * 16
+    assert pool_size <= max(initial_pool_size, 4)
+    assert len(_IDLE_CLIENTS) == pool_size
+    assert len(used_clients) <= pool_size
+
+
+class ExampleFloat(float):
+    pass
+
+
+@pytest.mark.parametrize(
+    "results_dict",
+    [
+        {"result": 0.3, "count": 9, "passed": True, "missing": None, "list": [1, "a"]},
+        {1: "non-string key"},
+        {"nan": float("nan"), "inf": float("inf")},
+        {"subclass": ExampleFloat(0.3)},
+        {"large": 2**70},
+    ],
+)
+def test_write_analysis_to_json_orjson_matches_json(
+    tmp_path, complete_field_dict, monkeypatch, results_dict
+):
+    pytest.importorskip("orjson")
     analysis = OnyxAnalysis()
-    for key, value in complete_field_dict.items():
-        setattr(analysis, key, value)
-    analysis.write_analysis_to_json(onyx_json_file_path)
+    analysis._set_analysis_attributes(copy_fields(complete_field_dict))
+    analysis.add_results("headline result", results_dict)
 
-    assert Path(onyx_json_file_path).exists()
+    orjson_file = analysis.write_analysis_to_json(tmp_path / "orjson_analysis.json")
+    monkeypatch.setattr("onyx_analysis_helper.onyx_analysis_helper_functions.orjson", None)
+    json_file = analysis.write_analysis_to_json(tmp_path / "json_analysis.json")
+
+    with Path(orjson_file).open("r") as file:
+        orjson_written = json.load(file)
+    with Path(json_file).open("r") as file:
+        json_written = json.load(file)
+
+    # Compare re-encoded values as NaN != NaN
+    assert json.dumps(orjson_written) == json.dumps(json_written)
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_write_analysis_to_json_date_fails(tmp_path, complete_field_dict, monkeypatch, use_orjson):
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr("onyx_analysis_helper.onyx_analysis_helper_functions.orjson", None)
+    analysis = OnyxAnalysis()
+    analysis._set_analysis_attributes(copy_fields(complete_field_dict))
+    analysis.analysis_date = datetime.date(2025, 8, 21)
+
+    with pytest.raises(TypeError):
+        analysis.write_analysis_to_json(tmp_path / "onyx_analysis.json")
 
 
 def test_check_required_fields_passes(complete_field_dict, caplog):
     analysis = OnyxAnalysis()
-    analysis._set_analysis_attributes(complete_field_dict)
+    analysis._set_analysis_attributes(copy_fields(complete_field_dict))
 
     field_fail = analysis._check_required_fields()
 
-    assert caplog.text == ""
+    assert not caplog.records
     assert not field_fail
 
 
@@ -299,10 +429,12 @@ def test_check_required_fields_fails(test_input, log_message, request, caplog):
     log_message = request.getfixturevalue(log_message)
 
     analysis = OnyxAnalysis()
-    analysis._set_analysis_attributes(fields_dict)
+    analysis._set_analysis_attributes(copy_fields(fields_dict))
     analysis._check_required_fields()
 
-    assert all(messages in caplog.text for messages in log_message)
+    messages = {record.getMessage() for record in caplog.records}
+
+    assert set(log_message) <= messages
 
 
 def test_read_analysis_from_json_pass(example_onyx_json_file, complete_field_dict):
@@ -312,17 +444,58 @@ def test_read_analysis_from_json_pass(example_onyx_json_file, complete_field_dic
     assert analysis.__dict__ == complete_field_dict
 
 
+def test_read_analysis_from_json_fail(example_onyx_json_file_fail):
+    analysis = OnyxAnalysis()
+    analysis.read_analysis_from_json(example_onyx_json_file_fail)
+
+    assert analysis._check_analysis_attributes()
+
+
+def test_set_analysis_attributes_json_strings(example_onyx_parsed, complete_field_dict):
+    analysis = OnyxAnalysis()
+    analysis._set_analysis_attributes(copy_fields(example_onyx_parsed))
+
+    assert analysis.__dict__ == complete_field_dict
+
+
+def test_set_analysis_attributes_invalid_json(complete_field_dict, caplog):
+    fields_dict = dict(complete_field_dict, methods="not json")
+    analysis = OnyxAnalysis()
+    analysis._set_analysis_attributes(copy_fields(fields_dict))
+
+    assert analysis.methods == "not json"
+    assert any(
+        record.getMessage().startswith("Could not decode methods as json")
+        for record in caplog.records
+    )
+
+
 def test_set_analysis_attributes(complete_field_dict):
     analysis = OnyxAnalysis()
-    analysis._set_analysis_attributes(complete_field_dict)
+    analysis._set_analysis_attributes(copy_fields(complete_field_dict))
     print(analysis.__dict__)
 
     assert analysis.__dict__ == complete_field_dict
 
 
+def test_to_dict(complete_field_dict):
+    analysis = OnyxAnalysis()
+    analysis._set_analysis_attributes(copy_fields(complete_field_dict))
+    fields_dict = analysis.to_dict()
+    fields_dict["name"] = "changed-name"
+    fields_dict["methods"]["method1"] = "changed method"
+    fields_dict["identifiers"].append("changed-identifier")
+    fields_dict["synthscape_records"].append("C-987654321")
+
+    assert analysis.name == complete_field_dict["name"]
+    assert analysis.methods == complete_field_dict["methods"]
+    assert analysis.identifiers == []
+    assert analysis.synthscape_records == ["C-123456789"]
+
+
 def test_check_analysis_attributes_pass(complete_field_dict):
     analysis = OnyxAnalysis()
-    analysis._set_analysis_attributes(complete_field_dict)
+    analysis._set_analysis_attributes(copy_fields(complete_field_dict))
     attr_fail = analysis._check_analysis_attributes()
 
     assert not attr_fail
@@ -330,18 +503,18 @@ def test_check_analysis_attributes_pass(complete_field_dict):
 
 def test_check_analysis_attributes_fail(invalid_field_dict, caplog):
     analysis = OnyxAnalysis()
-    analysis._set_analysis_attributes(invalid_field_dict)
+    analysis._set_analysis_attributes(copy_fields(invalid_field_dict))
     attr_fail = analysis._check_analysis_attributes()
 
     message = "Invalid attribute in onyx analysis: ['invalid_name']"
 
-    assert message in caplog.text
+    assert message in {record.getMessage() for record in caplog.records}
     assert attr_fail
 
 
 def test_check_analysis_object_pass(complete_field_dict):
     analysis = OnyxAnalysis()
-    analysis._set_analysis_attributes(complete_field_dict)
+    analysis._set_analysis_attributes(copy_fields(complete_field_dict))
 
     required_field_fail, attribute_fail = analysis.check_analysis_object()
 
@@ -351,7 +524,7 @@ def test_check_analysis_object_pass(complete_field_dict):
 
 def test_check_analysis_object_fail(invalid_field_dict):
     analysis = OnyxAnalysis()
-    analysis._set_analysis_attributes(invalid_field_dict)
+    analysis._set_analysis_attributes(copy_fields(invalid_field_dict))
 
     required_field_fail, attribute_fail = analysis.check_analysis_object()
 
@@ -380,3 +553,105 @@ def test_add_output_location_invalid():
     output_fail = analysis.add_output_location("not a file path")
 
     assert output_fail
+
+
+@pytest.mark.parametrize("connection_attempts,max_delay", [(1, 5), (2, 10), (3, 20), (10, 30)])
+def test_retry_delay(connection_attempts, max_delay):
+    delay = _retry_delay(connection_attempts)
+
+    assert 0 <= delay <= max_delay
+
+
+@pytest.mark.parametrize(
+    "exc,log_message",
+    [
+        (OnyxConnectionError("Example error"), "OnyxConnectionError: Example error"),
+        (OnyxConfigError("Example error"), "OnyxConfigError: Example error"),
+        (OnyxClientError("Example error"), "OnyxClientError: Example error"),
+        (
+            OnyxRequestError("Example error", ExampleResponse()),
+            "OnyxHTTPError: {'detail': 'Example error'}",
+        ),
+        (
+            OnyxRequestError("Example error", ExampleInvalidResponse()),
+            "OnyxHTTPError: <html>Bad Gateway</html>",
+        ),
+        (ValueError("Example error"), "Unhandled error: Example error"),
+    ],
+)
+def test_handle_onyx_error(exc, log_message, caplog):
+    result, exitcode = _handle_onyx_error(exc)
+
+    assert any(record.getMessage().startswith(log_message) for record in caplog.records)
+    assert result is None
+    assert exitcode == 1
+
+
+def test_onyx_client_reused():
+    with _onyx_client() as client, _onyx_client() as concurrent_client:
+        assert concurrent_client is not client
+    with _onyx_client() as reused_client:
+        assert reused_client in (client, concurrent_client)
+
+
+def test_repeated_debug_filter():
+    log_filter = _RepeatedDebugFilter(window=5)
+
+    def make_record(level, message, created):
+        record = logging.LogRecord("test", level, __file__, 1, message, None, None)
+        record.created = created
+        return record
+
+    assert log_filter.filter(make_record(logging.DEBUG, "Attempt number 1", 0))
+    assert not log_filter.filter(make_record(logging.DEBUG, "Attempt number 1", 1))
+    assert log_filter.filter(make_record(logging.DEBUG, "Attempt number 2", 1))
+    assert log_filter.filter(make_record(logging.ERROR, "Attempt number 1", 2))
+    assert log_filter.filter(make_record(logging.DEBUG, "Attempt number 1", 6))
+
+
+def test_retry_settings_env_override(retry_env, no_sleep):
+    retry_env.setenv("ONYX_ANALYSIS_MAX_ATTEMPTS", "5")
+    onyx_call, calls = make_onyx_call(OnyxConnectionError("Example error"))
+
+    assert onyx_call() == (None, 1)
+    assert len(calls) == 5
+
+
+def test_retry_settings_invalid_env(retry_env, caplog):
+    retry_env.setenv("ONYX_ANALYSIS_MAX_ATTEMPTS", "three")
+    retry_env.setenv("ONYX_ANALYSIS_RETRY_BASE_DELAY", "-1")
+
+    assert _retry_settings() == (3, 5.0)
+
+    messages = {record.getMessage() for record in caplog.records}
+
+    assert "Invalid value for ONYX_ANALYSIS_MAX_ATTEMPTS: 'three'. Using default of 3" in messages
+    assert (
+        "Invalid value for ONYX_ANALYSIS_RETRY_BASE_DELAY: '-1'. Using default of 5.0" in messages
+    )
+
+
+def test_call_to_onyx_retry_then_success(no_sleep):
+    onyx_call, calls = make_onyx_call(OnyxConnectionError("Example error"), "example-id")
+
+    assert onyx_call() == ("example-id", 0)
+    assert len(calls) == 2
+
+
+def test_call_to_onyx_attempts_exhausted(no_sleep, caplog):
+    max_attempts, _ = _retry_settings()
+    onyx_call, calls = make_onyx_call(OnyxConnectionError("Example error"))
+
+    assert onyx_call() == (None, 1)
+    assert len(calls) == max_attempts
+    assert any(
+        record.getMessage().startswith("OnyxConnectionError: Example error")
+        for record in caplog.records
+    )
+
+
+def test_call_to_onyx_no_retry(no_sleep):
+    onyx_call, calls = make_onyx_call(OnyxConfigError("Example error"), "example-id")
+
+    assert onyx_call() == (None, 1)
+    assert len(calls) == 1